@@ -1,11 +1,24 @@
 # /usr/bin/env python
 import sys
 import copy
-from math import *
+from math import ceil, pi, sqrt
 import numpy as np
 import numpy.random as random
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
+from numba import njit
+
+
+# Number of random numbers drawn at a time for the random walk.
+RANDOM_BUFFER_SIZE = 65536
+
+# The four possible steps of the random walk.
+DIRECTIONS = np.array([[1, 0], [-1, 0], [0, 1], [0, -1]], dtype=np.int32)
+
+# Cosines and sines of the evenly spaced angles
+# at which new walkers are placed.
+N_ANGLES = 4096
+COS_TABLE = np.cos(np.linspace(0.0, 2.0*pi, N_ANGLES, endpoint=False))
+SIN_TABLE = np.sin(np.linspace(0.0, 2.0*pi, N_ANGLES, endpoint=False))
 
 
 def count_particles(center, boxsize, grid):
@@ -19,35 +32,22 @@ def count_particles(center, boxsize, grid):
     [x0-boxsize, x0+boxsize] x [y0-boxsize, y0+boxsize]
     are 1.
     """
-    minx = center[0]-boxsize
+    minx = max(center[0]-boxsize, 0)
     maxx = center[0]+boxsize
-    miny = center[1]-boxsize
+    miny = max(center[1]-boxsize, 0)
     maxy = center[1]+boxsize
 
-    particles = 0
-    for i in range(minx, maxx):
-        for j in range(miny, maxx):
-            if grid[i,j]:
-                particles += 1
-    return particles
+    return int(grid[minx:maxx, miny:maxy].sum())
     
 
 def random_step(x,y):
     """
     Take a random step of length 1
     from the given coordinates (x,y)
-    and return the new coordinates.
+    and return the new coordinates as a tuple.
     """
-    rnd = random.rand()
-    if rnd < 0.25:
-        return [x+1, y]
-    elif rnd < 0.5:
-        return [x-1, y]
-    elif rnd < 0.75:
-        return [x, y+1]
-    else:
-        return [x, y-1]
-    return [x, y]
+    dx, dy = DIRECTIONS[random.randint(4)].tolist()
+    return x+dx, y+dy
 
 
 def neighbor_is_in_cluster(x,y, grid):
@@ -56,19 +56,20 @@ def neighbor_is_in_cluster(x,y, grid):
     (x, y) are already a part of the cluster.
     A point is part of the cluster if that point
     has the value of 1 in the given array 'grid'.
+    Points on or outside the edge of the grid are
+    never next to the cluster.
     """
-    try:
-        if grid[x-1,y]:
-            return True
-        elif grid[x+1,y]:
-            return True
-        elif grid[x,y-1]:
-            return True
-        elif grid[x,y+1]:
-            return True
-        else:
-            return False
-    except:
+    if x <= 0 or y <= 0 or x >= grid.shape[0]-1 or y >= grid.shape[1]-1:
+        return False
+    if grid[x-1,y]:
+        return True
+    elif grid[x+1,y]:
+        return True
+    elif grid[x,y-1]:
+        return True
+    elif grid[x,y+1]:
+        return True
+    else:
         return False
 
 
@@ -77,11 +78,13 @@ def pick_random_point(center, distance):
     Choose a random point at the given distance from
     the given center. Distance should be a real number
     and center should be an array of two real numbers,
-    [x, y].
+    [x, y]. The angle is picked from the N_ANGLES
+    angles in COS_TABLE and SIN_TABLE. The point is
+    returned as a tuple of integers.
     """
-    angle = random.rand()*2.0*pi    
-    point = center + distance * np.array([cos(angle), sin(angle)])
-    return np.array( [int(point[0]), int(point[1])] )
+    angle = random.randint(N_ANGLES)
+    return (int(center[0] + distance*COS_TABLE[angle]),
+            int(center[1] + distance*SIN_TABLE[angle]))
 
 
 def distance_from_center(point, center):
@@ -96,6 +99,137 @@ def distance_from_center(point, center):
     return ceil(sqrt( (x_2-x_1)**2 + (y_2-y_1)**2) )
 
 
+@njit(cache=True)
+def _walk_until_attach(frontier, steps, k, cx, cy, reach, x, y):
+    """
+    Random walk a particle from (x, y) until it is next to
+    the cluster, i.e. on a point with value 1 in 'frontier',
+    or leaves the square of half-width 'reach' around the
+    center (cx, cy).
+
+    The steps are read from the buffer 'steps' starting at
+    index k, and the buffer is refilled in place once used up.
+    Returns the final location of the particle, the index of
+    the next unused step and whether the particle found the
+    cluster.
+    """
+    while True:
+        # Change location by taking the random step.
+        step = steps[k]
+        x += DIRECTIONS[step, 0]
+        y += DIRECTIONS[step, 1]
+        k += 1
+        if k == RANDOM_BUFFER_SIZE:
+            steps[:] = np.random.randint(0, 4, RANDOM_BUFFER_SIZE)
+            k = 0
+
+        # Keep particles from reaching too far from r_cluster.
+        # A square around the center is enough for this, so only
+        # the distance along each axis is needed.
+        if abs(x-cx) > reach or abs(y-cy) > reach:
+            return x, y, k, False
+
+        # See if particle finds cluster.
+        if frontier[x, y]:
+            return x, y, k, True
+
+
+@njit(cache=True)
+def _simulate(size, particles, seed):
+    """
+    Compiled kernel of diffusion_simulation().
+
+    The helpers random_step(), distance_from_center(),
+    neighbor_is_in_cluster() and pick_random_point() are
+    inlined here and in _walk_until_attach() so the whole
+    random walk runs without Python function calls.
+    Returns the grid, its center and the number of particles
+    added to the cluster.
+
+    Walkers only move within r_cluster + max_distance of the
+    center, so the simulation stops once the cluster gets that
+    close to the edge of the grid. This keeps every read and
+    write inside the grid without bounds checks.
+    """
+    np.random.seed(seed)
+
+    # Clusters longest arm distance from center i.e. cluster radius.
+    r_cluster = 1
+
+    # Limit walkers wandering too far from cluster.
+    max_distance = 5
+
+    # Largest cluster radius for which walkers stay inside the grid.
+    r_max = size//2 - max_distance - 2
+
+    # Create a grid of bytes of the size 'size' x 'size'
+    # with all points having value 0.
+    grid = np.zeros((size, size), np.uint8)
+
+    # Set the center of the grid.
+    cx, cy = size//2, size//2
+
+    # Assign center point of the grid to have value 1 as a starting point.
+    grid[cx, cy] = 1
+
+    # Points next to the cluster but not in it have value 1 in
+    # 'frontier', so a walker finds the cluster with one lookup.
+    frontier = np.zeros((size, size), np.uint8)
+    frontier[cx-1, cy] = frontier[cx+1, cy] = 1
+    frontier[cx, cy-1] = frontier[cx, cy+1] = 1
+
+    # Random directions for the steps as indices to DIRECTIONS,
+    # drawn in blocks and refilled once used up.
+    steps = np.random.randint(0, 4, RANDOM_BUFFER_SIZE)
+    k = 0
+
+    # Distance from the center along either axis beyond which
+    # walkers are restarted.
+    reach = r_cluster + max_distance
+
+    # Add the parameter 'particles' times particles to cluster.
+    # Particles are released one at a time: every walk depends on the
+    # cluster left behind by the previous ones, so the loop is kept
+    # sequential rather than split over threads.
+    added = 0
+    while added < particles and r_cluster <= r_max:
+
+        # Put particle near cluster.
+        angle = np.random.randint(0, N_ANGLES)
+        x = int(cx + r_cluster*COS_TABLE[angle])
+        y = int(cy + r_cluster*SIN_TABLE[angle])
+
+        # Do the random walk, and start over near the cluster
+        # if the particle wanders too far.
+        x, y, k, attached = _walk_until_attach(frontier, steps, k,
+                                               cx, cy, reach, x, y)
+        if not attached:
+            continue
+
+        # Add then particle to the cluster.
+        grid[x, y] = 1
+        added += 1
+
+        # Move the frontier to the free neighbors of the new point.
+        frontier[x, y] = 0
+        if not grid[x-1, y]:
+            frontier[x-1, y] = 1
+        if not grid[x+1, y]:
+            frontier[x+1, y] = 1
+        if not grid[x, y-1]:
+            frontier[x, y-1] = 1
+        if not grid[x, y+1]:
+            frontier[x, y+1] = 1
+
+        # Update r_cluster if new the point is farthest one so far.
+        d_sq = (x-cx)**2 + (y-cy)**2
+        if d_sq > r_cluster**2:
+            r_cluster = ceil(sqrt(d_sq))
+            reach = r_cluster + max_distance
+
+    return grid, (cx, cy), added
+
+
 def diffusion_simulation(size, particles):
     """
     Runs a diffusion simulation.
@@ -109,60 +243,21 @@ def diffusion_simulation(size, particles):
     Function:
     Particles are placed some distance from cluster radius and
     are set to random walk until they reach the cluster. When
-    reached they attach to it.
+    reached they attach to it. The walk itself runs in the
+    compiled kernel _simulate(), seeded from numpy.random.
+    The simulation stops early if the cluster grows close
+    to the edge of the grid.
 
     Returns:
     # grid, matrix consisting cluster as its location defined by
     elements with value 1 with the rest being 0.
     # center, the center of the grid as an array, (x, y).
     """
-    # Clusters longest arm distance from center i.e. cluster radius.
-    r_cluster = 1
-
-    # Limit walkers wandering too far from cluster.
-    max_distance = 5
-    
-    # Create a grid of integers of the size 'size' x 'size'
-    # with all points having value 0.
-    grid = np.zeros((size, size), dtype=int)
-
-    # Set the center of the grid.
-    center = [size//2, size//2]
-    
-    # Assign center point of the grid to have value 1 as a starting point.
-    grid[center[0]][center[1]] = 1
-
-    # Add the parameter 'particles' times particles to cluster.
-    for i in range(particles):
-
-        # Put particle near cluster.
-        location = pick_random_point(center, r_cluster)
-        
-        # Do the random walk.
-        walk = True
-        while walk:
-            # Change location by taking the random step.
-            location = random_step(location[0], location[1])
-
-            # Keep track of how far the particle is from the center.
-            d = distance_from_center(location, center)
-
-            # See if particle finds cluster.
-            if neighbor_is_in_cluster(location[0], location[1], grid):
-                walk = False
-
-                # Add then particle to the cluster.
-                grid[location[0]][location[1]] = 1
-                
-                # Update r_cluster if new the point is farthest one so far.
-                if d > r_cluster:
-                    r_cluster = d
-            
-            # Keep particles from reaching too far from r_cluster.
-            if d > r_cluster + max_distance:
-                location = pick_random_point(center, r_cluster)
-
-    return grid, center
+    grid, center, added = _simulate(size, particles, random.randint(2**31))
+    if added < particles:
+        print("Cluster reached the edge of the grid after "
+              + str(added) + " particles.")
+    return grid, [center[0], center[1]]
 
 
 def read_grid_from_file(filename):
@@ -182,20 +277,11 @@ def read_grid_from_file(filename):
     The function returns a grid describing the cluster and the
     position of the initial seed.
     """
-    f = open(filename)
-    lines = f.readlines()
-    f.close()
-    maxindex = 0
-    
-    parts = lines[0].split()
-    center = [ int(parts[0]), int(parts[1]) ]
-        
-    grid = np.array( [ [False]*(center[0]*2) ]*(center[1]*2) )    
+    points = np.loadtxt(filename, dtype=np.int64, ndmin=2)
+    center = [ int(points[0,0]), int(points[0,1]) ]
 
-    for line in lines:
-        parts = line.split()
-        if len(parts) > 0:
-            grid[ int(parts[0]), int(parts[1]) ] = True
+    grid = np.zeros((center[1]*2, center[0]*2), dtype=np.uint8)
+    grid[ points[:,0], points[:,1] ] = 1
 
     return grid, center
 
@@ -216,44 +302,37 @@ def calculate_fractal_dimension(grid, center):
             a point that belongs in the cluster
     * center: the coordinates of the initial seed of the cluster    
     """
-    # store the statistics in these lists
-    particlecount = []
-    logsize = []
-    logcount = []
-    R = 1 # box size
-
-    # Loop over increasing box area.
-    walk = True
-    while walk:
-        # Calculate how many particles are found for box sized R.
-        N = count_particles(center, R, grid)
-
-        # Break out of the loop if increasing R doesn't increase N,
-        # meaning we've reached the outermost edge of the cluster.
-        if N > 10 and N == particlecount[-1]:
-            break
-        
-        particlecount.append(N)
+    # Summed area table: table[i,j] is the number of particles
+    # in grid[:i,:j], so any box count is four lookups.
+    table = np.pad(grid, ((1, 0), (1, 0))).cumsum(0, dtype=np.int64).cumsum(1)
+    size_x, size_y = grid.shape
+    cx, cy = center[0], center[1]
+
+    # Largest box size needed, at which the box
+    # [cx-R, cx+R) x [cy-R, cy+R) covers the whole cluster.
+    xs, ys = np.nonzero(grid)
+    R_max = max(cx-xs.min(), xs.max()-cx+1, cy-ys.min(), ys.max()-cy+1)
+
+    # Calculate how many particles are found for all box sizes R at
+    # once, i.e. the same boxes as count_particles(center, R, grid).
+    R = np.arange(1, R_max+1)
+    minx, maxx = np.maximum(cx-R, 0), np.minimum(cx+R, size_x)
+    miny, maxy = np.maximum(cy-R, 0), np.minimum(cy+R, size_y)
+    N = (table[maxx, maxy] - table[minx, maxy]
+         - table[maxx, miny] + table[minx, miny])
+
+    # Calculate logarithms ln N and ln R.
+    logsize = np.log(R)
+    logcount = np.log(N)
 
-        # Calculate logarithms ln N and ln R and store values.
-        logsize.append(log(R))
-        logcount.append(log(N))
-
-        R += 1
-        
-    # fit a straight line to the data
-    logsize = np.array(logsize)
-    logcount = np.array(logcount)
-    
     # The first and last values in the data to be included in the fit.
     # Eyeballed to represend the linear part of the fit. ;)
     first_value = 0
     last_value = -10
 
-    popt, pcov = curve_fit(linearfit, 
-                            logsize[first_value:last_value],
-                            logcount[first_value:last_value], 
-                            p0 = [1.5, 2.0]) # initial guess for parameters
+    # Least squares line, solved directly as it is linear in a and b.
+    popt = np.polyfit(logsize[first_value:last_value],
+                      logcount[first_value:last_value], 1)
     print( "Estimated value for the fractal dimension: " + str(popt[0]) )
 
 
@@ -276,15 +355,13 @@ def write_cluster_file(grid, center):
     Write the cluster in a datafile which can be
     later read in using read_grid_from_file().
     """
-    size = len(grid[0])
-    writelines = str(center[0])+" "+str(center[0])+"\n"
-    
-    for i in range(size):
-        for j in range(size):
-            if grid[i,j]:
-                writelines += str(i)+" "+str(j)+"\n "
+    # Only the points of the cluster are written, after the center.
+    xs, ys = np.nonzero(grid)
+    writelines = [str(center[0])+" "+str(center[1])]
+    writelines += [str(i)+" "+str(j) for i, j in zip(xs.tolist(), ys.tolist())]
+
     f = open('cluster.txt','w')
-    f.write(writelines)
+    f.write("\n".join(writelines)+"\n")
     f.close()
     
     